@@ -9,15 +9,59 @@ agent/cli.py：命令行入口（前端层的 CLI 版本）
 2) 组装 workspace / engine / logs 路径
 3) 调用 workflow（真正逻辑在 agent/workflow.py）
 4) 把结果以 JSON 打印出来，并用退出码表示成功/失败（便于脚本化）
+
+--workspace 可以重复传：多个项目在同一个进程里并发修复，
+共享同一个热引擎 —— Python 启动和引擎预热的成本摊到 N 个任务上，
+一个项目在等编译时事件循环可以去推进别的项目。
 """
 
 import argparse # argparse 用于解析命令行参数
+import asyncio # asyncio 用于并发跑多个 workspace 的 workflow
+import hashlib # hashlib 用于给每个 workspace 的日志目录起不冲突的名字
 import json # json 用于处理 JSON 数据
 import sys # sys 用于访问与 Python 解释器相关的变量和函数
 from pathlib import Path # pathlib 处理路径
+from typing import Any, Dict, List # 类型标注
 
 from agent.engine_client import EngineClient # 引入 EngineClient 类, 用于与 C++ 引擎交互
-from agent.workflow import run_workflow # 引入 run_workflow 函数, 用于执行工作流
+from agent.workflow import run_workflow # 引入 run_workflow 协程, 用于执行工作流
+
+
+def _ws_slug(workspace: Path) -> str:
+    """workspace → 日志子目录名：目录名 + 路径哈希（同名不同路径的项目也不会撞）。"""
+    digest = hashlib.blake2b(str(workspace).encode("utf-8"), digest_size=4).hexdigest()
+    return f"{workspace.name}-{digest}"
+
+
+async def _run_all(
+    task: str,
+    workspaces: List[Path],
+    engine: EngineClient,
+    logs_root: Path,
+    debug_logs: bool,
+) -> List[Dict[str, Any]]:
+    """
+    并发跑所有 workspace 的 workflow（asyncio.gather），共享同一个引擎。
+
+    - 单 workspace：日志直接放 logs_root（和以前完全一样）
+    - 多 workspace：每个项目一个日志子目录，build_*/apply.json/.wsindex.json
+      互不干扰（.wsindex.json 是按 workspace 的指纹，绝不能共用一份）
+    """
+
+    async def one(workspace: Path) -> Dict[str, Any]:
+        logs = logs_root if len(workspaces) == 1 else logs_root / _ws_slug(workspace)
+        logs.mkdir(parents=True, exist_ok=True)
+        result = await run_workflow(
+            task=task,
+            workspace=workspace,
+            engine=engine,
+            logs_root=logs,
+            debug_logs=debug_logs,
+        )
+        # 多项目时结果里带上 workspace，否则分不清哪条是谁的
+        return dict(result, workspace=str(workspace)) if len(workspaces) > 1 else result
+
+    return list(await asyncio.gather(*(one(w) for w in workspaces)))
 
 
 def main() -> int:
@@ -27,8 +71,14 @@ def main() -> int:
     # task：自然语言任务描述。当前 demo 里不会做复杂理解，主要用于日志记录/扩展点。
     parser.add_argument("task", help="Natural language task, e.g. 修复示例项目编译错误")
 
-    # workspace：要被分析/修改/运行的项目根目录（示例是 examples/demo_cpp）
-    parser.add_argument("--workspace", required=True, help="Workspace path (project to modify)")
+    # workspace：要被分析/修改/运行的项目根目录（示例是 examples/demo_cpp）。
+    # 可重复传多个，一次进程并发修复（CI 批量场景不用反复付 Python 启动成本）。
+    parser.add_argument(
+        "--workspace",
+        required=True,
+        action="append",
+        help="Workspace path (repeatable; multiple workspaces are fixed concurrently)",
+    )
     parser.add_argument(
         "--engine",
         default=str(Path(__file__).resolve().parents[1] / "engine" / "build" / "engine_cli"),
@@ -39,23 +89,33 @@ def main() -> int:
         default=str(Path(".agent_logs").resolve()),
         help="Directory for run logs",
     )
+    # --debug-logs：额外落盘 task/plan/retrieve 等演示用中间产物，并 pretty-print JSON。
+    # 常规运行省掉这些写盘（热路径上每次 run 少好几次文件 I/O）。
+    parser.add_argument("--debug-logs", action="store_true", help="Write pretty-printed demo artifacts (plan/retrieve/...)")
     args = parser.parse_args()
 
     # resolve()：转成绝对路径，避免因为当前工作目录不同导致找不到文件
-    workspace = Path(args.workspace).resolve()
+    workspaces = [Path(w).resolve() for w in args.workspace]
     engine_path = Path(args.engine).resolve()
     logs_root = Path(args.logs).resolve()
     logs_root.mkdir(parents=True, exist_ok=True)
 
-    # EngineClient：封装对 C++ 引擎 CLI 的调用（subprocess + JSON 解析）
-    engine = EngineClient(engine_path=engine_path)
+    # EngineClient：封装对 C++ 引擎常驻进程的调用（JSON-RPC over pipes）。
+    # 用 with 保活：同一个热引擎被所有 workspace 的所有修复重试复用，
+    # 退出时优雅地发 shutdown。
+    with EngineClient(engine_path=engine_path) as engine:
+        # 固定 pipeline（Plan → Retrieve → Patch → Run → Fix）× N 个 workspace，
+        # asyncio.gather 并发推进（一个在编译时另一个可以检索/打补丁）
+        results = asyncio.run(
+            _run_all(args.task, workspaces, engine, logs_root, args.debug_logs)
+        )
 
-    # run_workflow：执行固定的 pipeline（Plan → Retrieve → Patch → Run → Fix）
-    result = run_workflow(task=args.task, workspace=workspace, engine=engine, logs_root=logs_root)
-    sys.stdout.write(json.dumps(result, ensure_ascii=False, indent=2) + "\n")
+    # 单 workspace 保持老输出（一个 JSON 对象）；多 workspace 输出 JSON 数组
+    out: Any = results[0] if len(results) == 1 else results
+    sys.stdout.write(json.dumps(out, ensure_ascii=False, indent=2) + "\n")
 
-    # 退出码：0=成功；2=失败（便于脚本/CI 判断）
-    return 0 if result.get("ok") else 2
+    # 退出码：0=全部成功；2=任一失败（便于脚本/CI 判断）
+    return 0 if all(r.get("ok") for r in results) else 2
 
 
 if __name__ == "__main__":
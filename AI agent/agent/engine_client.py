@@ -4,12 +4,22 @@ agent/engine_client.py：Python 侧对 C++ 引擎（engine_cli）的“薄封装
 为什么需要这个文件？
 - 你希望 agent 编排层（Python）能调用本地能力（C++ 引擎）：
   例如 list_files / read_file / search_text / apply_patch / rollback 等。
-- 最稳妥的方式是：Python 通过 subprocess 启动一个 CLI 程序，然后用 JSON 通信。
+- 最稳妥的方式是：Python 启动 engine_cli 子进程，然后用 JSON 通信。
   这样避免了 pybind11/ffi 在毕设阶段容易卡住的工程复杂度，也更容易答辩解释。
 
+通信方式（当前版本）：
+- 旧版每次调用都 subprocess.run 一个新进程，每次都付一遍 fork+exec+动态链接的
+  启动开销（Linux 上约 5~30 ms），一次 workflow 要付 3~4 次。
+- 现在改成：启动一次 `engine_cli --serve` 常驻子进程，之后每个调用只是
+  “写一行 JSON 请求 → 读一行 JSON 应答”（NDJSON），进程启动成本被摊销掉，
+  每次 RPC 的耗时只剩引擎真正干活的部分。
+- 超过 64KB 的大应答不走管道：引擎把结果 JSON 写进一段共享内存，
+  管道上只回一个存根（{"shm":true,"bytes":N}），Python 直接从内存里解析。
+  不支持共享内存的平台自动退回纯管道。
+
 EngineClient 的职责：
-1) 统一构造 engine_cli 的命令行参数
-2) 解析 engine_cli 输出的 JSON（stdout）
+1) 管理 engine_cli --serve 常驻子进程的生命周期（懒启动 / close / with 语句）
+2) 组装 {"id", "method", "params"} 请求并解析应答 JSON
 3) 把结果以 dict 返回给上层 workflow
 
 注意：
@@ -17,82 +27,306 @@ EngineClient 的职责：
 - 真正项目里建议你把 JSON schema 固定下来，并对输入输出做更严格的校验。
 """
 
+import asyncio
 import json
+import os
 import subprocess
-from dataclasses import dataclass
+import threading
+from itertools import count
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson  # 可选依赖：直接从 bytes 解析，比标准库快 5~10 倍（没装就退回 json）
+except ImportError:
+    orjson = None
+
+# 计算工作区时间戳时要剪掉的目录（与引擎 default_ignored_dirs 保持一致，
+# 否则 .git/build 里的文件一动缓存就永远失效）
+_IGNORED_DIRS = {".git", "build", "node_modules", "dist", "__pycache__",
+                 ".venv", ".idea", ".vscode", ".agent_snapshots"}
+
+
+def _tree_stamp(root: Path) -> int:
+    """
+    root 下所有（未被忽略的）文件里最新的 st_mtime_ns。
+    用途：作为搜索缓存 key 的一部分 —— 工作区只要有文件变过，stamp 就变，缓存自然失效。
+    """
+    latest = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            d for d in dirnames if d not in _IGNORED_DIRS and not d.endswith(".dSYM")
+        ]
+        for name in filenames:
+            try:
+                mtime = os.stat(os.path.join(dirpath, name)).st_mtime_ns
+            except OSError:
+                continue
+            if mtime > latest:
+                latest = mtime
+    return latest
 
 
-@dataclass(frozen=True)
 class EngineClient:
+    # __slots__：实例属性就固定这几个，不再带每实例的 __dict__ ——
+    # 属性读写变成 C 级偏移访问（_rpc 热路径一次要摸四五个属性），
+    # 内存也省一张哈希表。顺带把“随手往 client 上挂新状态”变成显式决定：
+    # 加属性必须先进这张表。
+    __slots__ = (
+        "engine_path",
+        "_argv",
+        "_proc",
+        "_lock",
+        "_ids",
+        "_search_cache",
+        "_shm",
+        "_shm_disabled",
+    )
+
     # engine_path：engine_cli 可执行文件的绝对路径
-    engine_path: Path
+    def __init__(self, engine_path: Path):
+        self.engine_path = engine_path
+        # 构造时就验证路径并把 spawn 参数冻结成元组：
+        # - “引擎路径写错了”这种错误应该在构造时就炸出来（fail fast），
+        #   而不是第一次 RPC 时才从 FileNotFoundError 里翻出来；
+        # - argv 只算一次，之后每次（重）启动子进程直接复用，
+        #   不用反复做 str(Path) 转换。
+        argv0 = str(engine_path)
+        if not engine_path.is_file():
+            raise FileNotFoundError(f"engine_cli not found: {argv0}")
+        if not os.access(argv0, os.X_OK):
+            raise PermissionError(f"engine_cli not executable: {argv0}")
+        self._argv = (argv0, "--serve")
+        # 常驻子进程懒启动：第一次 RPC 时才 spawn，避免“只想构造对象”也付启动成本
+        self._proc: Optional[subprocess.Popen] = None
+        # 协议是“一问一答”，用锁保证并发调用时请求/应答不会交错
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        # search_text 的 LRU=1 缓存：(key, 结果)。
+        # workflow 的重试循环会用同样的参数反复检索；只要工作区没变
+        # （key 里带着 _tree_stamp），第二次起就能省掉整个引擎往返。
+        self._search_cache: Optional[Tuple[tuple, Dict[str, Any]]] = None
+        # 大应答（>64KB）的共享内存通道：引擎把结果 JSON 直接写进这段内存，
+        # 管道上只回一个几十字节的存根，应答不用整个挤过内核管道缓冲。
+        # 惰性创建；创建失败（平台不支持/重名）就永久禁用，走纯管道路径。
+        # demo 规模（几个小文件）体现不出差距，这是给真实仓库的检索结果留的路。
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._shm_disabled = False
 
-    def _run(self, args: list[str]) -> Dict[str, Any]:
+    # ---- 生命周期管理 ----
+
+    def _ensure_proc(self) -> subprocess.Popen:
+        """确保 --serve 子进程活着（没有就启动，死了就重启）。
+
+        管道用二进制模式：text=True 会让 Python 先把整个应答解码成 str，
+        json.loads 再扫一遍 —— 大应答（检索结果/文件内容）要过两趟。
+        二进制模式下应答 bytes 直接喂给 orjson/json.loads（两者都认 bytes），
+        只剩解析这一趟。我们每次写完都显式 flush，不依赖行缓冲。
         """
-        运行 engine_cli 并返回解析后的 JSON。
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(
+                self._argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        return self._proc
+
+    def _ensure_shm(self) -> Optional[shared_memory.SharedMemory]:
+        """惰性创建共享内存段（8MB 虚拟内存，页按需分配，实际占用跟着用量走）。"""
+        if self._shm is None and not self._shm_disabled:
+            try:
+                self._shm = shared_memory.SharedMemory(
+                    create=True, size=8 << 20, name=f"agent-{os.getpid():x}"
+                )
+            except (OSError, ValueError):
+                self._shm_disabled = True
+        return self._shm
+
+    def close(self) -> None:
+        """结束常驻子进程：先礼貌地发 shutdown，再关 stdin（EOF 兜底），最后 kill 保险。"""
+        shm, self._shm = self._shm, None
+        if shm is not None:
+            shm.close()
+            try:
+                shm.unlink()  # 创建者负责删除，否则段会留在 /dev/shm 里
+            except OSError:
+                pass
+        proc, self._proc = self._proc, None
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            if proc.stdin:
+                proc.stdin.write(
+                    json.dumps({"id": 0, "method": "shutdown", "params": {}}).encode("utf-8") + b"\n"
+                )
+                proc.stdin.flush()
+                proc.stdin.close()
+            proc.wait(timeout=2)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            proc.kill()
+            proc.wait()
+
+    def __enter__(self) -> "EngineClient":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    # ---- RPC 底层 ----
+
+    def _rpc(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        向常驻引擎发送一条请求并等待一条应答。
 
         约定：
-        - engine_cli 正常情况下 stdout 输出一行 JSON
-        - 退出码非 0 时，可能仍然会输出 JSON（包含 ok=false 与 error 字段）
-        - 如果 stdout 不是合法 JSON，则认为引擎异常（engine_invalid_json）
+        - 请求：{"id": N, "method": "...", "params": {...}}，一行一条
+        - 应答：{"id": N, "ok": true/false, ...}，一行一条（bytes，解析时才解码）
+        - 大应答：引擎把结果写进共享内存，管道上只回
+          {"id": N, "ok": true, "shm": true, "bytes": M} 这样的存根
+        - 应答不是合法 JSON 或子进程中途退出，都按引擎异常处理
         """
-        proc = subprocess.run(
-            [str(self.engine_path), *args],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        if proc.returncode != 0 and not proc.stdout.strip():
-            return {"ok": False, "error": "engine_failed", "stderr": proc.stderr, "args": args}
-        try:
-            payload = json.loads(proc.stdout)
-        except json.JSONDecodeError:
-            return {
-                "ok": False,
-                "error": "engine_invalid_json",
-                "stdout": proc.stdout,
-                "stderr": proc.stderr,
-                "args": args,
-            }
-        if proc.returncode != 0 and payload.get("ok") is True:
-            payload["ok"] = False
-            payload["error"] = payload.get("error", "engine_nonzero_exit")
+        with self._lock:
+            proc = self._ensure_proc()
+            shm = self._ensure_shm()
+            if shm is not None:
+                # 告诉引擎可用的段名和容量；结果超过 64KB 时它会写进去
+                params = dict(params, shm=shm.name, cap=shm.size)
+            req = {"id": next(self._ids), "method": method, "params": params}
+            try:
+                proc.stdin.write(json.dumps(req, ensure_ascii=False).encode("utf-8") + b"\n")
+                proc.stdin.flush()
+                line = proc.stdout.readline()
+            except (BrokenPipeError, OSError):
+                line = b""
+            if not line:
+                # stdout 已 EOF：引擎挂了。收尸并带回 stderr 方便排查。
+                _, stderr = proc.communicate()
+                self._proc = None
+                return {
+                    "ok": False,
+                    "error": "engine_failed",
+                    "stderr": stderr[:2048].decode("utf-8", "replace"),
+                    "method": method,
+                }
+            try:
+                # orjson 直接吃 bytes（SIMD 解析）；标准库 json.loads 也认 bytes，
+                # 两条路都不用先 decode 成 str 再扫一遍。
+                loads = json.loads if orjson is None else orjson.loads
+                payload = loads(line)
+                if payload.get("shm") and shm is not None:
+                    # 真正的结果在共享内存里；必须在锁内取出，
+                    # 下一个 RPC 会复用同一段内存。
+                    payload = loads(bytes(shm.buf[: payload["bytes"]]))
+            except ValueError:  # orjson.JSONDecodeError / json.JSONDecodeError 都是 ValueError
+                return {
+                    "ok": False,
+                    "error": "engine_invalid_json",
+                    "stdout": line[:2048].decode("utf-8", "replace"),
+                    "method": method,
+                }
+        payload.pop("id", None)
         return payload
 
+    async def _rpc_async(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        _rpc 的 async 版本：把阻塞的管道读写放进线程池，让事件循环可以同时做别的事
+        （例如并发消费 build.sh 的输出、并发写日志）。
+
+        注意：引擎的 serve 循环是单线程“一问一答”，所以两个 RPC 之间不会真正并行；
+        并发的收益在于 RPC 可以和其他 I/O（编译、磁盘）重叠。
+        """
+        return await asyncio.to_thread(self._rpc, method, params)
+
+    # ---- 引擎能力封装 ----
+
+    def warm(self, root: Path) -> Dict[str, Any]:
+        # 预热：让常驻引擎把 root 走一遍（文件进页缓存；未来的索引也在这里首建）。
+        # 配合“引擎跨重试保活”使用：预热一次，后续每轮重试的检索都是热的。
+        return self._rpc("warm", {"root": str(root)})
+
     def list_files(self, root: Path) -> Dict[str, Any]:
         # 列出 root 下的文件树（会过滤掉常见的大目录，如 .git/node_modules 等）
-        return self._run(["list-files", "--root", str(root)])
+        return self._rpc("list_files", {"root": str(root)})
 
     def read_file(self, path: Path, max_bytes: int = 200_000) -> Dict[str, Any]:
         # 读取文件内容（max_bytes 用于控制上下文大小，避免一次读太大）
-        return self._run(["read-file", "--path", str(path), "--max-bytes", str(max_bytes)])
+        return self._rpc("read_file", {"path": str(path), "max_bytes": max_bytes})
 
     def search_text(
         self, root: Path, query: str, topk: int = 10, max_bytes: int = 200_000
     ) -> Dict[str, Any]:
         # 简单的全文搜索（demo 版本：逐文件逐行 find；后续可替换成倒排索引/rg/tree-sitter）
-        return self._run(
-            [
-                "search-text",
-                "--root",
-                str(root),
-                "--query",
-                query,
-                "--topk",
-                str(topk),
-                "--max-bytes",
-                str(max_bytes),
-            ]
+        # 带 LRU=1 缓存：key 含工作区最新 mtime，文件一变 key 就变（只保留最新一份）。
+        key = (str(root), query, topk, max_bytes, _tree_stamp(root))
+        if self._search_cache is not None and self._search_cache[0] == key:
+            return self._search_cache[1]
+        payload = self._rpc(
+            "search_text",
+            {"root": str(root), "query": query, "topk": topk, "max_bytes": max_bytes},
         )
+        if payload.get("ok"):
+            self._search_cache = (key, payload)
+        return payload
 
     def apply_edits(self, root: Path, edits_json_path: Path) -> Dict[str, Any]:
         # 应用“按行替换”的 edits.json，并自动做快照备份（root/.agent_snapshots/<id>/...）
-        return self._run(
-            ["apply-edits", "--root", str(root), "--edits-json", str(edits_json_path)]
+        return self._rpc(
+            "apply_edits", {"root": str(root), "edits_json": str(edits_json_path)}
+        )
+
+    def insert_includes(self, root: Path, relpath: str, headers: list) -> Dict[str, Any]:
+        # 让引擎原子地完成“读文件 → 插入 #include → 写回 + 快照”。
+        # 跨进程只传头文件名列表，文件内容不用再经 JSON 序列化来回搬两趟。
+        # headers 用逗号拼接传输，适配引擎侧的轻量 JSON 解析。
+        return self._rpc(
+            "insert_includes",
+            {"root": str(root), "path": relpath, "headers": ",".join(headers)},
+        )
+
+    def fix_missing_includes(self, root: Path, relpath: str, headers: list) -> Dict[str, Any]:
+        # insert_includes 的融合版：引擎先过滤掉文件里已有的 #include 再插入，
+        # “读 → 查重 → 插入 → 快照”一次往返完成。应答里的 inserted 是
+        # 实际新增的头文件（全都已存在时为 []，且不产生快照）。
+        return self._rpc(
+            "fix_missing_includes",
+            {"root": str(root), "path": relpath, "headers": ",".join(headers)},
         )
 
     def rollback(self, root: Path, snapshot_id: str) -> Dict[str, Any]:
         # 回滚到某次 apply_edits 之前的版本（把快照目录里的文件写回 root）
-        return self._run(["rollback", "--root", str(root), "--snapshot-id", snapshot_id])
+        return self._rpc("rollback", {"root": str(root), "snapshot_id": snapshot_id})
+
+    # ---- async 封装（给 asyncio 版 workflow 用，语义与同步版一一对应）----
+
+    async def warm_async(self, root: Path) -> Dict[str, Any]:
+        return await self._rpc_async("warm", {"root": str(root)})
+
+    async def read_file_async(self, path: Path, max_bytes: int = 200_000) -> Dict[str, Any]:
+        return await self._rpc_async(
+            "read_file", {"path": str(path), "max_bytes": max_bytes}
+        )
+
+    async def search_text_async(
+        self, root: Path, query: str, topk: int = 10, max_bytes: int = 200_000
+    ) -> Dict[str, Any]:
+        # 走同步版以共享 LRU=1 缓存（命中时整个 to_thread 里只剩一次 os.walk）
+        return await asyncio.to_thread(self.search_text, root, query, topk, max_bytes)
+
+    async def apply_edits_async(self, root: Path, edits_json_path: Path) -> Dict[str, Any]:
+        return await self._rpc_async(
+            "apply_edits", {"root": str(root), "edits_json": str(edits_json_path)}
+        )
+
+    async def insert_includes_async(self, root: Path, relpath: str, headers: list) -> Dict[str, Any]:
+        return await self._rpc_async(
+            "insert_includes",
+            {"root": str(root), "path": relpath, "headers": ",".join(headers)},
+        )
+
+    async def fix_missing_includes_async(self, root: Path, relpath: str, headers: list) -> Dict[str, Any]:
+        return await self._rpc_async(
+            "fix_missing_includes",
+            {"root": str(root), "path": relpath, "headers": ",".join(headers)},
+        )
@@ -14,35 +14,206 @@ agent/workflow.py：一个“最小可跑通”的端到端工作流（demo 版
 后续扩展思路：
 - 你可以把 _plan() 替换成 LLM 生成计划（≤5步）。
 - 你可以把“推断缺 include”替换成 LLM 生成 unified diff，再交给 C++ patch 引擎应用。
-- 你可以把 Run/Fix 做成循环：失败→提取错误→检索上下文→生成修复 patch→再 run（最多 2 次）。
+- Run/Fix 已经是循环了（失败→提取错误→检索→patch→再 run，最多 max_retries 轮），
+  引擎进程由 cli.py 用 with 语句跨整个循环保活。
 """
 
+import asyncio
 import json
+import os
 import re
-import subprocess
+import signal
+import tempfile
+import time
+from collections import deque
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, IO, Iterable, List, Optional, Tuple
 
+try:
+    import orjson  # 可选依赖：Rust 实现的 JSON，dumps/loads 比标准库快 5~10 倍
+except ImportError:
+    orjson = None
+
+from agent import wsindex
 from agent.engine_client import EngineClient
 
 
-def _run_cmd(cmd: List[str], cwd: Path, timeout_s: int = 30) -> Dict[str, Any]:
+def _dump_json(path: Path, obj: Any, pretty: bool = False) -> None:
+    """
+    统一的 JSON 落盘出口。
+
+    - 默认紧凑格式：pretty-print 大约慢 2 倍还多写不少字节，而紧凑 JSON
+      round-trip 之后内容一模一样，“可复现的实验编号”不受影响；
+    - 装了 orjson 就走 orjson（输出 bytes 直写，免一层 str 中转）；
+    - --debug-logs 模式下用 indent=2，方便人眼翻日志。
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        path.write_bytes(orjson.dumps(obj, option=option))
+    elif pretty:
+        path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    else:
+        path.write_text(
+            json.dumps(obj, ensure_ascii=False, separators=(",", ":")), encoding="utf-8"
+        )
+
+
+# 每个流在内存里最多保留的行数（头 + 尾各一半预算）。
+# 规则提取和未来的 LLM prompt 只需要错误的开头和结尾，不需要整个 50 MB 的诊断。
+_CAP_LINES = 2000
+
+
+def _capped_lines(lines: Iterable[bytes]) -> str:
     """
-    运行一个外部命令，并把结果结构化返回。
+    把一个按行的字节流压缩成“头 _CAP_LINES 行 + 尾 _CAP_LINES 行”的文本，
+    中间被丢掉的行数会标注出来。
+
+    这样真实 C++ 项目一次失败编译产出 5~50 MB 诊断时，内存占用是常数，
+    而不是把全部输出先 decode 成一个巨大的 str 再整体 json.dumps。
+    """
+    head: List[bytes] = []
+    tail: deque = deque(maxlen=_CAP_LINES)
+    dropped = 0
+    for line in lines:
+        if len(head) < _CAP_LINES:
+            head.append(line)
+        else:
+            if len(tail) == _CAP_LINES:
+                dropped += 1
+            tail.append(line)
+    parts = b"".join(head)
+    if tail:
+        if dropped:
+            parts += b"... <" + str(dropped).encode() + b" lines dropped> ...\n"
+        parts += b"".join(tail)
+    return parts.decode("utf-8", "replace")
+
+
+def _capped_text_from_file(f: IO[bytes]) -> str:
+    """从文件对象（已写好的完整日志）读出截断后的文本。逐行迭代，内存有界。"""
+    f.seek(0)
+    return _capped_lines(f)
+
+
+async def _spawn_build(workspace: Path, timeout_s: int = 30, log_path: Optional[Path] = None) -> Dict[str, Any]:
+    """
+    运行 workspace 下的 ./build.sh，并把结果结构化返回。
 
     为什么要结构化？
     - 方便日志落盘、复现、答辩展示（cmd/exit code/stdout/stderr 一目了然）
     - 未来接 LLM 时，也可以把 stderr 的关键部分喂给模型做修复
+
+    为什么用 os.posix_spawn 而不是 subprocess？
+    - subprocess 只有在 cwd=None 等一串条件都满足时才走 posix_spawn 快路径，
+      我们以前传了 cwd=workspace，所以每次 build 都是完整的 fork()+exec()，
+      要拷贝父进程页表 —— agent 以后挂上嵌入/LLM 缓存、RSS 变大后这笔开销会越来越疼。
+    - 好在 build.sh 第一行就 cd 到脚本自己的目录，根本不需要父进程帮它 chdir：
+      直接用绝对路径 posix_spawn（glibc 走 CLONE_VFORK|CLONE_VM，免页表拷贝）。
+
+    输出策略（配合上面的截断逻辑）：
+    - stdout/stderr 通过 posix_spawn 的 file_actions 直接 dup2 到文件 fd，
+      子进程由内核直写磁盘，Python 完全不在管道上搬运字节；
+    - 结束后从文件里读回截断后的头尾文本，stderr 的完整原始日志留在 log_path。
     """
-    proc = subprocess.run(
-        cmd,
-        cwd=str(cwd),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        timeout=timeout_s,
+    script = workspace / "build.sh"
+    cmd = ["./build.sh"]
+    stdout_tmp = tempfile.TemporaryFile()
+    err_fd = (
+        os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if log_path is not None
+        else os.open(os.devnull, os.O_WRONLY)
+    )
+    try:
+        pid = os.posix_spawn(
+            str(script),
+            cmd,
+            dict(os.environ),
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, stdout_tmp.fileno(), 1),
+                (os.POSIX_SPAWN_DUP2, err_fd, 2),
+            ],
+        )
+    finally:
+        os.close(err_fd)
+
+    # 非阻塞 waitpid + asyncio.sleep：等待期间事件循环照常跑别的任务
+    deadline = time.monotonic() + timeout_s
+    timed_out = False
+    while True:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid == pid:
+            break
+        if time.monotonic() >= deadline:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            timed_out = True
+            break
+        await asyncio.sleep(0.02)
+
+    if timed_out:
+        stdout_tmp.close()
+        return {
+            "code": -1,
+            "stdout": "",
+            "stderr_tail": f"timeout after {timeout_s}s",
+            "cmd": cmd,
+        }
+
+    with stdout_tmp:
+        stdout_text = _capped_text_from_file(stdout_tmp)
+    result: Dict[str, Any] = {
+        "code": os.waitstatus_to_exitcode(status),
+        "stdout": stdout_text,
+        "stderr_tail": "",
+        "cmd": cmd,
+    }
+    if log_path is not None:
+        with open(log_path, "rb") as f:
+            result["stderr_tail"] = _capped_text_from_file(f)
+        result["stderr_log"] = log_path.name
+    return result
+
+
+# 编译器对“缺 include”的报错措辞（clang 与 gcc 各不相同，gcc 还用弯引号 ‘ ’）。
+_QUOTE = "['‘’]"  # 直引号 ' 或 gcc 的弯引号 ‘ ’
+
+
+def _missing_member_re(member: str) -> "re.Pattern[str]":
+    """给 std:: 下某个缺失符号（chrono / this_thread / ...）生成确认用 regex。"""
+    return re.compile(
+        rf"(?:no member named|is not a member of)\s+{_QUOTE}{member}{_QUOTE}\s+in\s+namespace\s+{_QUOTE}std{_QUOTE}"
+        rf"|{_QUOTE}{member}{_QUOTE} is not a member of {_QUOTE}std{_QUOTE}"
+        rf"|{_QUOTE}std::{member}{_QUOTE} has not been declared"
+        rf"|namespace\s+{_QUOTE}std::{member}{_QUOTE}"
+    )
+
+
+# 缺 include 的规则表：(header 名, 预过滤子串, 确认用 regex)。
+# 为什么分两级？
+# - 预过滤用 `in` 做 C 级子串查找（memchr/two-way，比 re 的字节码解释器快一个量级），
+#   stderr 里连符号名都没出现的 header 直接跳过，连 regex 都不用跑；
+# - 命中 needle 的才用 regex 确认措辞，避免误报。
+# 这样规则表从 2 条涨到几十条（vector/string/optional/...）也只是每条多一次
+# 快速子串扫描，而不是每条多一个全文 regex。
+HEADER_RULES: List[Tuple[str, Tuple[str, ...], "re.Pattern[str]"]] = [
+    ("chrono", ("chrono",), _missing_member_re("chrono")),
+    ("thread", ("this_thread",), _missing_member_re("this_thread")),
+]
+
+# header 名 → 代码里实际出现的 std:: 符号名（两者不总一致，如 thread/this_thread）。
+# 检索上下文时用它来构造精准 query。
+_HEADER_SYMBOL = {"thread": "this_thread", "chrono": "chrono"}
+
+# 源文件侧“用到了符号 / 已有 include”的单趟扫描 regex（由 HEADER_RULES 生成）。
+# 逐个 `"std::chrono::" in content` 判断是 每个 header 两次 全文扫描；
+# 合成一个带命名分组的模式后 finditer 一趟扫完，规则表再涨也还是一趟。
+# 分组名形如 use_chrono / inc_chrono，按前缀区分两类命中。
+_INC_USE_RE = re.compile(
+    "|".join(
+        rf"(?P<use_{h}>std::{_HEADER_SYMBOL.get(h, h)}::)|(?P<inc_{h}>#include\s*<{h}>)"
+        for h, _, _ in HEADER_RULES
     )
-    return {"code": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr, "cmd": cmd}
+)
 
 
 def _extract_missing_includes(build_stderr: str) -> List[str]:
@@ -53,32 +224,84 @@ def _extract_missing_includes(build_stderr: str) -> List[str]:
     - 看到 std::this_thread 相关报错 → 推断需要 #include <thread>
     - 看到 std::chrono 相关报错 → 推断需要 #include <chrono>
 
+    实现：按 HEADER_RULES 逐条走“子串预过滤 → regex 确认”两级判断。
+    要支持新 header 只需往表里加一行，不用改这里的逻辑。
+
     真正毕设版本你可以：
     - 扩展更多规则（比如 vector/string/optional 等）
     - 或直接把 build_stderr + 相关代码片段交给 LLM 生成 patch
     """
     need: List[str] = []
-
-    def add(header: str) -> None:
-        if header not in need:
+    for header, needles, rx in HEADER_RULES:
+        if any(n in build_stderr for n in needles) and rx.search(build_stderr):
             need.append(header)
+    return need
 
-    if re.search(r"(no member named|is not a member of)\s+'chrono'\s+in\s+namespace\s+'std'", build_stderr) or re.search(
-        r"error: 'chrono' is not a member of 'std'", build_stderr
-    ):
-        add("chrono")
 
-    if re.search(r"(no member named|is not a member of)\s+'this_thread'\s+in\s+namespace\s+'std'", build_stderr) or re.search(
-        r"error: 'this_thread' is not a member of 'std'", build_stderr
-    ):
-        add("thread")
+async def _apply_includes_via_edits(
+    engine: EngineClient,
+    workspace: Path,
+    run_dir: Path,
+    content: str,
+    needed_headers: List[str],
+) -> Dict[str, Any]:
+    """
+    兜底路径：引擎不支持 fix_missing_includes（旧版二进制）时，在 Python 侧算出
+    最小编辑并走通用的 apply-edits。
 
-    if re.search(r"namespace\s+'std::this_thread'", build_stderr) or re.search(
-        r"namespace\s+‘std::this_thread’", build_stderr
-    ):
-        add("thread")
+    把 include 插入到最后一个 #include 之后。只替换锚点那一行，而不是把整个
+    文件当 replacement 重写一遍 —— 引擎写盘和快照的量从 O(文件大小) 降到 O(改动)。
 
-    return need
+    实现上不做 splitlines：找锚点只需要一个偏移量，用 rfind/find/count 这些
+    C 级单趟扫描直接在原字符串上算，省掉 N 个子串对象的分配和一次整文件 join。
+
+    返回值补上 inserted 字段，和引擎 fix_missing_includes 的应答保持同构
+    （查重在这里做：主路径里查重已经归引擎管了）。
+    """
+    needed_headers = [h for h in needed_headers if f"#include <{h}>" not in content]
+    if not needed_headers:
+        return {"ok": True, "inserted": []}
+    include_block = "\n".join(f"#include <{h}>" for h in needed_headers)
+
+    # 最后一个 #include 行的起点：正常在某个换行之后；整个文件只有一行
+    # include 且在文件开头时，rfind 找不到，用 startswith 兜住。
+    p = content.rfind("\n#include")
+    if p != -1:
+        line_start = p + 1
+    elif content.startswith("#include"):
+        line_start = 0
+    else:
+        line_start = -1
+
+    # 引擎的 edits 协议只有“按行替换”，所以用“锚点行替换成 自己+新增行”来表达插入
+    if line_start >= 0:
+        line_end = content.find("\n", line_start)
+        if line_end == -1:
+            line_end = len(content)
+        anchor = content.count("\n", 0, line_start) + 1  # 1-based 行号
+        replacement = content[line_start:line_end] + "\n" + include_block
+    else:
+        anchor = 1  # 文件里还没有任何 include：插在第 1 行之前
+        first_end = content.find("\n")
+        first_line = content[:first_end] if first_end != -1 else content
+        replacement = include_block + ("\n" + first_line if content else "")
+
+    edits = {
+        "edits": [
+            {
+                "path": "main.cpp",
+                "start_line": anchor,
+                "end_line": anchor,
+                "replacement": replacement,
+            }
+        ]
+    }
+    edits_path = run_dir / "edits.json"
+    _dump_json(edits_path, edits)  # 不是日志而是引擎的输入，必须写
+    apply_res = await engine.apply_edits_async(root=workspace, edits_json_path=edits_path)
+    if apply_res.get("ok"):
+        apply_res["inserted"] = needed_headers
+    return apply_res
 
 
 def _plan(task: str) -> List[str]:
@@ -97,106 +320,172 @@ def _plan(task: str) -> List[str]:
     ]
 
 
-def run_workflow(task: str, workspace: Path, engine: EngineClient, logs_root: Path) -> Dict[str, Any]:
+async def run_workflow(
+    task: str,
+    workspace: Path,
+    engine: EngineClient,
+    logs_root: Path,
+    max_retries: int = 2,
+    debug_logs: bool = False,
+) -> Dict[str, Any]:
     """
     执行一次完整 workflow，并把过程落盘到 logs_root/<run_id>/。
+    修复是一个循环：失败 → 提取错误 → 检索 → 打补丁 → 再 build，最多 max_retries 轮。
 
     你可以把 run_id 当成一次“可复现的实验编号”：
-    - task.txt：用户需求
-    - plan.json：计划
+    - task.txt：用户需求（仅 --debug-logs）
+    - plan.json：计划（仅 --debug-logs）
     - build_0.json：第一次 build 输出（通常会失败）
-    - retrieve.json：检索结果（demo 里只是示意）
-    - edits.json：将要应用的修改
-    - apply.json：引擎应用结果（含 snapshot_id）
-    - build_1.json：第二次 build 输出（希望成功）
+    - retrieve.json：检索结果（demo 里只是示意；仅 --debug-logs，多轮重试时记录最后一轮）
+    - edits.json：将要应用的修改（仅旧引擎兜底路径会生成）
+    - apply.json：引擎应用结果（含 snapshot_id；多轮重试时记录最后一轮）
+    - build_{n}.json：第 n 轮修复后的 build 输出（最后一份希望成功）
     """
-    run_id = str(int(__import__("time").time() * 1000))
+    # 0) 增量短路：工作区指纹没变 + 上次 apply 成功 → 整个 pipeline 都是重复劳动，
+    #    直接复用上次的结果（连 build 都不用跑：没有任何输入变过）。
+    index_path = logs_root / ".wsindex.json"
+    prev_index = wsindex.load(index_path)
+    if prev_index is not None:
+        cur_fp = wsindex.fingerprint(workspace)
+        last_run = prev_index.get("last_run")
+        if cur_fp["merkle_root"] == prev_index.get("merkle_root") and last_run:
+            last_apply = wsindex.load(logs_root / str(last_run) / "apply.json")
+            if last_apply is not None and last_apply.get("ok"):
+                return {
+                    "ok": True,
+                    "run_id": str(last_run),
+                    "cached": True,
+                    "message": "workspace unchanged since last successful fix",
+                }
+
+    # run_id：毫秒时间戳（十六进制，目录名更短）+ pid。
+    # time_ns() 全程整数运算，不像 time()*1000 那样过 float 丢精度；
+    # 带上 pid 是为了将来并发跑多个 workflow 时 run 目录不会撞名。
+    run_id = f"{time.time_ns() // 1_000_000:013x}-{os.getpid():x}"
     run_dir = logs_root / run_id
     run_dir.mkdir(parents=True, exist_ok=True)
 
-    # 1) 记录任务与计划（这两份是答辩最需要展示的“流程证据”）
-    (run_dir / "task.txt").write_text(task, encoding="utf-8")
-    plan = _plan(task)
-    (run_dir / "plan.json").write_text(json.dumps(plan, ensure_ascii=False, indent=2), encoding="utf-8")
+    # 1) 记录任务与计划（答辩展示用的“流程证据”，常规运行为了省 I/O 不写，
+    #    需要时加 --debug-logs 打开）
+    if debug_logs:
+        (run_dir / "task.txt").write_text(task, encoding="utf-8")
+        _dump_json(run_dir / "plan.json", _plan(task), pretty=True)
 
     # 2) Run：运行示例项目自己的 build.sh（第一次通常会失败，产生编译错误日志）
-    build = _run_cmd(["./build.sh"], cwd=workspace, timeout_s=60)
-    (run_dir / "build_0.json").write_text(json.dumps(build, ensure_ascii=False, indent=2), encoding="utf-8")
+    build = await _spawn_build(workspace, timeout_s=60, log_path=run_dir / "build_0.log")
+    _dump_json(run_dir / "build_0.json", build, pretty=debug_logs)
     if build["code"] == 0:
         return {"ok": True, "run_id": run_id, "message": "build already OK"}
 
-    # 3) Fix(规则)：从 stderr 推断需要补哪些 include（demo 版本只处理 thread/chrono）
-    needed_headers = _extract_missing_includes(build["stderr"])
-    if not needed_headers:
-        return {"ok": False, "run_id": run_id, "error": "unsupported_build_error", "build": build}
-
-    # 4) Retrieve：示意性调用一下搜索接口（真实版本应该用“错误关键词/符号名”去检索）
-    retrieve = {"search": engine.search_text(root=workspace, query="std::", topk=5)}
-    (run_dir / "retrieve.json").write_text(
-        json.dumps(retrieve, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
-
-    # 5) 读取目标文件内容（demo 里固定是 main.cpp；真实版本应由检索/计划决定目标文件）
-    target_path = workspace / "main.cpp"
-    file_payload = engine.read_file(target_path)
-    if not file_payload.get("ok"):
-        return {"ok": False, "run_id": run_id, "error": "read_file_failed", "detail": file_payload}
-
-    content = file_payload["content"]
-    # 某些编译器/情况下，stderr 只报第一个错误。
-    # 所以我们也从代码里做一次补充推断：出现 std::chrono:: / std::this_thread:: 但没 include 就加上。
-    if "std::chrono::" in content and "#include <chrono>" not in content and "chrono" not in needed_headers:
-        needed_headers.append("chrono")
-    if "std::this_thread::" in content and "#include <thread>" not in content and "thread" not in needed_headers:
-        needed_headers.append("thread")
-
-    needed_headers = [h for h in needed_headers if f"#include <{h}>" not in content]
-    if not needed_headers:
-        return {"ok": False, "run_id": run_id, "error": "includes_already_present"}
-
-    # 6) Patch（最小改动）：把 include 插入到最后一个 #include 之后
-    lines = content.splitlines()
-    insert_at = 0
-    for i, line in enumerate(lines):
-        if line.startswith("#include"):
-            insert_at = i + 1
-    new_lines = lines[:insert_at] + [f"#include <{h}>" for h in needed_headers] + lines[insert_at:]
-    replacement = "\n".join(new_lines) + ("\n" if content.endswith("\n") else "")
-
-    # 7) 把修改写成 edits.json（engine_cli 的 apply-edits 只认识这种格式）
-    edits = {
-        "edits": [
-            {
-                "path": "main.cpp",
-                "start_line": 1,
-                "end_line": len(lines),
-                "replacement": replacement,
-            }
-        ]
-    }
-    edits_path = run_dir / "edits.json"
-    edits_path.write_text(json.dumps(edits, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    # 8) Apply：调用引擎应用修改；引擎会在 workspace/.agent_snapshots 下生成快照
-    apply_res = engine.apply_edits(root=workspace, edits_json_path=edits_path)
-    (run_dir / "apply.json").write_text(
-        json.dumps(apply_res, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
-    if not apply_res.get("ok"):
-        return {"ok": False, "run_id": run_id, "error": "apply_failed", "detail": apply_res}
-
-    # 9) 再次运行 build 验证修复是否成功
-    build2 = _run_cmd(["./build.sh"], cwd=workspace, timeout_s=60)
-    (run_dir / "build_1.json").write_text(
-        json.dumps(build2, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
-    if build2["code"] != 0:
-        return {"ok": False, "run_id": run_id, "error": "still_failing", "build": build2}
+    # 2.5) Warm：engine 是 cli.py 用 with 语句保活的同一个常驻实例，
+    #    跨下面所有重试迭代复用。先让它把工作区过一遍（文件进页缓存 /
+    #    未来的索引在这里首建），预热只付一次，之后每轮检索都是热的。
+    await engine.warm_async(workspace)
+
+    # 3~9) Fix 循环：提取错误 → 检索上下文 → 打补丁 → 重新 build，最多 max_retries 轮。
+    #    每轮 build 的输出落盘为 build_{n}.json/.log；retrieve.json / apply.json
+    #    记录的是最后一轮的情况。
+    added_includes: List[str] = []
+    apply_res: Dict[str, Any] = {}
+    for attempt in range(max_retries):
+        # 3) Fix(规则)：从 stderr 推断需要补哪些 include（demo 版本只处理 thread/chrono）
+        needed_headers = _extract_missing_includes(build["stderr_tail"])
+        if not needed_headers:
+            return {"ok": False, "run_id": run_id, "error": "unsupported_build_error", "build": build}
+
+        # 4)+5) Retrieve + 读目标文件。
+        #    Retrieve 的结果目前只有 retrieve.json 一个消费者，所以只在 --debug-logs
+        #    时才真的发起 —— 以前无条件用 query="std::" 扫全工作区，纯属白给的
+        #    一次引擎往返。查询也改成针对真正缺失的符号（topk=3），而不是撒大网。
+        #    目标文件 demo 里固定是 main.cpp（真实版本应由检索/计划决定目标文件）。
+        target_path = workspace / "main.cpp"
+        search_task = None
+        if debug_logs:
+            symbol = _HEADER_SYMBOL.get(needed_headers[0], needed_headers[0])
+            search_task = asyncio.create_task(
+                engine.search_text_async(root=workspace, query=f"std::{symbol}::", topk=3)
+            )
+
+        # 目标文件在本地磁盘上，Python 自己 open() 就行：跨进程的 JSON 传输
+        # （C++ 侧 escape + Python 侧 decode）才是成本，读文件本身不是。
+        # engine.read_file 保留在接口里，将来给“索引过的/预处理过的”内容用。
+        try:
+            content = target_path.read_text(encoding="utf-8", errors="replace")
+        except OSError as e:
+            if search_task is not None:
+                search_task.cancel()
+            return {"ok": False, "run_id": run_id, "error": "read_file_failed", "detail": str(e)}
+
+        if search_task is not None:
+            _dump_json(run_dir / "retrieve.json", {"search": await search_task}, pretty=True)
+        # 某些编译器/情况下，stderr 只报第一个错误。
+        # 所以我们也从代码里做一次补充推断：用到了 std::chrono:: / std::this_thread::
+        # 但没 include 的 header 也进候选。判定走 _INC_USE_RE 的一趟 finditer，
+        # 而不是每个 header 各做两次 `in content` 全文扫描。
+        state = {h: [False, False] for h, _, _ in HEADER_RULES}  # header -> [用到, 已include]
+        for m in _INC_USE_RE.finditer(content):
+            kind, _, header = m.lastgroup.partition("_")
+            state[header][0 if kind == "use" else 1] = True
+        for header, (used, included) in state.items():
+            if used and not included and header not in needed_headers:
+                needed_headers.append(header)
+
+        # 6)+7)+8) Patch+Apply：引擎的 fix_missing_includes 一次 RPC 完成
+        #    “读 → 过滤已有的 include → 插入 → 快照 → 写回”。查重也放在引擎侧，
+        #    跨进程只传候选头文件名列表，回来的 inserted 是实际新增的那几个。
+        #    旧版引擎没有这个方法时退回 edits.json 路径（Python 侧查重 + apply_edits）。
+        apply_res = await engine.fix_missing_includes_async(
+            root=workspace, relpath="main.cpp", headers=needed_headers
+        )
+        if apply_res.get("error") in ("unknown_method", "not_supported"):
+            apply_res = await _apply_includes_via_edits(
+                engine, workspace, run_dir, content, needed_headers
+            )
+        _dump_json(run_dir / "apply.json", apply_res, pretty=debug_logs)
+        if not apply_res.get("ok"):
+            return {"ok": False, "run_id": run_id, "error": "apply_failed", "detail": apply_res}
+        if not apply_res.get("inserted"):
+            # 候选头文件全都已经在文件里了：stderr 的推断和文件现状对不上，
+            # 继续重试也只会原地打转，按老规则当错误返回。
+            return {"ok": False, "run_id": run_id, "error": "includes_already_present"}
+        added_includes.extend(apply_res["inserted"])
+
+        # 9) 再次运行 build 验证修复是否成功；还不行就带着新 stderr 进下一轮
+        build = await _spawn_build(
+            workspace, timeout_s=60, log_path=run_dir / f"build_{attempt + 1}.log"
+        )
+        _dump_json(run_dir / f"build_{attempt + 1}.json", build, pretty=debug_logs)
+        if build["code"] == 0:
+            break
+    else:
+        return {"ok": False, "run_id": run_id, "error": "still_failing", "build": build}
+
+    # 10) 修复成功：把（修复后的）工作区指纹落盘，供下次运行短路
+    wsindex.store(index_path, wsindex.fingerprint(workspace), last_run=run_id)
 
     return {
         "ok": True,
         "run_id": run_id,
         "fixed": "missing_include",
-        "added_includes": needed_headers,
+        "added_includes": added_includes,
         "snapshot_id": apply_res.get("snapshot_id"),
     }
+
+
+def run_workflow_sync(
+    task: str,
+    workspace: Path,
+    engine: EngineClient,
+    logs_root: Path,
+    debug_logs: bool = False,
+) -> Dict[str, Any]:
+    """同步入口：给 cli.py 这类非 async 调用方用，内部起一个事件循环跑完整个 workflow。"""
+    return asyncio.run(
+        run_workflow(
+            task=task,
+            workspace=workspace,
+            engine=engine,
+            logs_root=logs_root,
+            debug_logs=debug_logs,
+        )
+    )
@@ -0,0 +1,84 @@
+"""
+agent/wsindex.py：工作区增量指纹（Merkle 风格）
+
+解决什么问题？
+- workflow 的每次运行都把工作区当成“冷启动”：重新检索、重新读文件、重新组 edits。
+- 但如果上次修复成功之后工作区根本没变过，这些工作全是重复的。
+
+做法：
+- 给工作区算一份指纹：每个文件记 (size, mtime_ns, 内容哈希)，
+  再把 (路径, 内容哈希) 排序后整体哈希一次，得到 merkle_root。
+- 指纹持久化在 logs_root/.wsindex.json。workflow 入口先对比 merkle_root：
+  没变 + 上次 apply 成功 → 直接短路返回，不碰引擎也不跑 build。
+
+哈希选型：
+- 用标准库的 blake2b（digest_size=8）。xxhash3 会更快，但本仓库刻意零第三方依赖，
+  而且 demo 规模下哈希不是瓶颈（瓶颈是进程/编译）。
+- 有了每文件哈希，之后还可以做“只重新索引变过的文件”这类增量能力。
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from agent.engine_client import _IGNORED_DIRS
+
+
+def _content_digest(path: str) -> str:
+    """单个文件内容的 blake2b-64 哈希（十六进制）。读失败返回空串（文件可能正被写）。"""
+    h = hashlib.blake2b(digest_size=8)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except OSError:
+        return ""
+    return h.hexdigest()
+
+
+def fingerprint(root: Path) -> Dict[str, Any]:
+    """
+    计算 root 的指纹：
+    {"merkle_root": "...", "files": {relpath: [size, mtime_ns, digest]}}
+
+    目录剪枝和引擎的忽略规则保持一致（.git/build/快照目录等不参与指纹），
+    这样 apply 产生的快照、日志不会让指纹虚假变化。
+    """
+    files: Dict[str, Any] = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            d for d in dirnames if d not in _IGNORED_DIRS and not d.endswith(".dSYM")
+        ]
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            rel = os.path.relpath(full, root).replace(os.sep, "/")
+            files[rel] = [st.st_size, st.st_mtime_ns, _content_digest(full)]
+
+    top = hashlib.blake2b(digest_size=8)
+    for rel in sorted(files):
+        top.update(rel.encode("utf-8"))
+        top.update(files[rel][2].encode("ascii"))
+    return {"merkle_root": top.hexdigest(), "files": files}
+
+
+def load(index_path: Path) -> Optional[Dict[str, Any]]:
+    """读取上次持久化的指纹；没有或损坏都当作“没有缓存”处理。"""
+    try:
+        return json.loads(index_path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def store(index_path: Path, fp: Dict[str, Any], last_run: str) -> None:
+    """持久化指纹 + 最近一次成功 run 的编号（短路返回时要引用它的日志目录）。"""
+    payload = dict(fp)
+    payload["last_run"] = last_run
+    index_path.write_text(
+        json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8"
+    )
@@ -6,17 +6,26 @@
   - read-file：读取文件内容（限制最大字节数，避免上下文爆炸）
   - search-text：全文搜索（demo 版：逐文件逐行 find；后续可换索引/rg/tree-sitter）
   - apply-edits：应用“按行替换”的编辑指令，并生成快照（snapshot）
+  - insert-includes：在最后一个 #include 之后插入给定头文件（读/改/写/快照一步完成，
+    文件内容不用再经过 JSON 跨进程来回搬一遍）
+  - fix-missing-includes：insert-includes 的融合版 —— 先过滤掉文件里已有的
+    #include 再插入，“读 → 查重 → 插入 → 快照”一次调用完成
   - rollback：把快照内容写回去，实现回滚
+  - --serve：常驻模式。从 stdin 逐行读取 JSON 请求（NDJSON），逐行写回 JSON 应答。
+    这样 Python 侧只需要 fork+exec 一次，后续每个调用都省掉进程启动的开销
+    （Linux 上一次 fork+exec+动态链接大约 5~30 ms，一次 workflow 会调 3~4 次）。
 
   设计动机（答辩友好）：
   - Python 负责“编排/工作流/LLM”，C++ 负责“本地高性能/工程能力”
   - 两者用 CLI 子进程 + JSON 通信：最稳、最容易调试、跨平台也清晰
+  - 一次性子命令模式保留不变，方便在终端里手工调试单个能力
 */
 
 #include <algorithm>
 #include <chrono>
 #include <cstdio>
 #include <cstddef>
+#include <cstring>
 #include <filesystem>
 #include <fstream>
 #include <iostream>
@@ -28,6 +37,15 @@
 #include <utility>
 #include <vector>
 
+// POSIX 共享内存（大应答直写，见 serve_loop）。mac/Linux 都有；
+// 其他平台退化成纯管道（Python 侧创建段失败时也会自动退回）。
+#if defined(__unix__) || defined(__APPLE__)
+#define ENGINE_HAS_SHM 1
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
 namespace fs = std::filesystem; // C++17 文件系统库
 
 static void print_usage(const char* argv0) { // 打印用法说明
@@ -38,9 +56,16 @@ static void print_usage(const char* argv0) { // 打印用法说明
       << "  " << argv0
       << " search-text --root PATH --query TEXT [--topk K] [--max-bytes N]\n"
       << "  " << argv0 << " apply-edits --root PATH --edits-json PATH\n"
+      << "  " << argv0
+      << " insert-includes --root PATH --path REL --headers H1,H2,...\n"
+      << "  " << argv0
+      << " fix-missing-includes --root PATH --path REL --headers H1,H2,...\n"
       << "  " << argv0 << " rollback --root PATH --snapshot-id ID\n"
+      << "  " << argv0 << " --serve\n"
       << "\n"
-      << "All commands output JSON on stdout.\n";
+      << "All commands output JSON on stdout.\n"
+      << "--serve reads NDJSON requests {\"id\":..,\"method\":..,\"params\":{..}} "
+         "from stdin and writes one JSON reply per line.\n";
 }
 
 static std::string json_escape(const std::string& s) {
@@ -81,6 +106,106 @@ static std::string to_posix_path(const fs::path& p) { // 把路径转换为 POSI
   return p.generic_string();
 }
 
+// 将 JSON 字符串字面量（不含外围引号）反转义成真实内容。
+//
+// 重要细节：要正确区分这两种情况：
+// - "\n"  表示换行（应该变成真正的 '\n'）
+// - "\\n" 表示两个字符：反斜杠 + n（应该保留为 "\\n"）
+//
+// 之前用简单的 regex_replace 会把 "\\n" 误处理成 "\<换行>"，导致 C++ 代码出现行续接。
+static bool json_unescape(const std::string& in, std::string& out,
+                          std::string& uerr) {
+  out.clear();
+  out.reserve(in.size());
+  for (std::size_t i = 0; i < in.size(); i++) {
+    char c = in[i];
+    if (c != '\\') {
+      out.push_back(c);
+      continue;
+    }
+    if (i + 1 >= in.size()) {
+      uerr = "invalid_escape_trailing_backslash";
+      return false;
+    }
+    char n = in[++i];
+    switch (n) {
+      case 'n':
+        out.push_back('\n');
+        break;
+      case 't':
+        out.push_back('\t');
+        break;
+      case 'r':
+        out.push_back('\r');
+        break;
+      case '"':
+        out.push_back('"');
+        break;
+      case '\\':
+        out.push_back('\\');
+        break;
+      case '/':
+        out.push_back('/');
+        break;
+      case 'u': {
+        if (i + 4 >= in.size()) {
+          uerr = "invalid_unicode_escape";
+          return false;
+        }
+        unsigned int code = 0;
+        for (int k = 0; k < 4; k++) {
+          char h = in[i + 1 + k];
+          code <<= 4;
+          if (h >= '0' && h <= '9')
+            code |= static_cast<unsigned int>(h - '0');
+          else if (h >= 'a' && h <= 'f')
+            code |= static_cast<unsigned int>(10 + h - 'a');
+          else if (h >= 'A' && h <= 'F')
+            code |= static_cast<unsigned int>(10 + h - 'A');
+          else {
+            uerr = "invalid_unicode_escape";
+            return false;
+          }
+        }
+        i += 4;
+        // demo 版：只保证 ASCII 可读；更完整的 UTF-8 编码可作为后续增强点。
+        if (code <= 0x7F) {
+          out.push_back(static_cast<char>(code));
+        } else {
+          out.push_back('?');
+        }
+        break;
+      }
+      default:
+        uerr = "unsupported_escape";
+        return false;
+    }
+  }
+  return true;
+}
+
+// 从一行 JSON 文本里取出 "key":"value" 形式的字符串字段（带反转义）。
+// 说明：这是和 parse_edits_json 同一风格的“最小解析”，只为 --serve 协议服务；
+// 真正项目里建议换成完整的 JSON 库。
+static std::optional<std::string> json_get_string(const std::string& text,
+                                                 const std::string& key) {
+  std::regex re("\"" + key + "\"\\s*:\\s*\"((?:\\\\.|[^\"\\\\])*)\"");
+  std::smatch m;
+  if (!std::regex_search(text, m, re)) return std::nullopt;
+  std::string out, uerr;
+  if (!json_unescape(m[1].str(), out, uerr)) return std::nullopt;
+  return out;
+}
+
+// 取出 "key":123 形式的整数字段。
+static std::optional<long long> json_get_int(const std::string& text,
+                                             const std::string& key) {
+  std::regex re("\"" + key + "\"\\s*:\\s*(-?[0-9]+)");
+  std::smatch m;
+  if (!std::regex_search(text, m, re)) return std::nullopt;
+  return std::stoll(m[1].str());
+}
+
 static bool read_file_bytes(const fs::path& path, std::size_t max_bytes,
                             std::string& out) {
   // 以二进制读取文件，并截断到 max_bytes（用于控制上下文大小）
@@ -152,7 +277,11 @@ static bool is_likely_text(const std::string& bytes) {
   return suspicious * 100 / sample < 5;
 }
 
-static int cmd_list_files(const fs::path& root) {
+// 下面的 do_* 函数把每个能力的结果组装成一行 JSON 字符串返回（不直接打印）。
+// 这样同一份实现可以同时服务两种模式：
+// - 一次性子命令模式：emit() 打印并转换成进程退出码
+// - --serve 常驻模式：serve_loop() 把 JSON 包上 "id" 后逐行写回
+static std::string do_list_files(const fs::path& root) {
   std::vector<std::string> files;
   std::error_code ec;
   for (auto it = fs::recursive_directory_iterator(root, ec);
@@ -170,31 +299,32 @@ static int cmd_list_files(const fs::path& root) {
   }
   std::sort(files.begin(), files.end());
 
-  std::cout << "{\"ok\":true,\"root\":\"" << json_escape(to_posix_path(root))
-            << "\",\"files\":[";
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"root\":\"" << json_escape(to_posix_path(root))
+      << "\",\"files\":[";
   for (std::size_t i = 0; i < files.size(); i++) {
-    if (i) std::cout << ",";
-    std::cout << "\"" << json_escape(files[i]) << "\"";
+    if (i) oss << ",";
+    oss << "\"" << json_escape(files[i]) << "\"";
   }
-  std::cout << "]}\n";
-  return 0;
+  oss << "]}";
+  return oss.str();
 }
 
-static int cmd_read_file(const fs::path& path, std::size_t max_bytes) {
+static std::string do_read_file(const fs::path& path, std::size_t max_bytes) {
   std::string bytes;
   if (!read_file_bytes(path, max_bytes, bytes)) {
-    std::cout << "{\"ok\":false,\"error\":\"read_failed\",\"path\":\""
-              << json_escape(to_posix_path(path)) << "\"}\n";
-    return 2;
+    return "{\"ok\":false,\"error\":\"read_failed\",\"path\":\"" +
+           json_escape(to_posix_path(path)) + "\"}";
   }
-  std::cout << "{\"ok\":true,\"path\":\"" << json_escape(to_posix_path(path))
-            << "\",\"truncated\":" << (bytes.size() >= max_bytes ? "true" : "false")
-            << ",\"content\":\"" << json_escape(bytes) << "\"}\n";
-  return 0;
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"path\":\"" << json_escape(to_posix_path(path))
+      << "\",\"truncated\":" << (bytes.size() >= max_bytes ? "true" : "false")
+      << ",\"content\":\"" << json_escape(bytes) << "\"}";
+  return oss.str();
 }
 
-static int cmd_search_text(const fs::path& root, const std::string& query,
-                           int topk, std::size_t max_bytes) {
+static std::string do_search_text(const fs::path& root, const std::string& query,
+                                  int topk, std::size_t max_bytes) {
   struct Match {
     std::string path;
     int line = 0;
@@ -236,16 +366,16 @@ static int cmd_search_text(const fs::path& root, const std::string& query,
   if (topk < 1) topk = 1;
   if (static_cast<int>(scored.size()) > topk) scored.resize(topk);
 
-  std::cout << "{\"ok\":true,\"query\":\"" << json_escape(query)
-            << "\",\"results\":[";
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"query\":\"" << json_escape(query) << "\",\"results\":[";
   for (std::size_t i = 0; i < scored.size(); i++) {
-    if (i) std::cout << ",";
+    if (i) oss << ",";
     const auto& r = scored[i].second;
-    std::cout << "{\"path\":\"" << json_escape(r.path) << "\",\"line\":"
-              << r.line << ",\"snippet\":\"" << json_escape(r.snippet) << "\"}";
+    oss << "{\"path\":\"" << json_escape(r.path) << "\",\"line\":" << r.line
+        << ",\"snippet\":\"" << json_escape(r.snippet) << "\"}";
   }
-  std::cout << "]}\n";
-  return 0;
+  oss << "]}";
+  return oss.str();
 }
 
 static std::optional<std::string> read_text_file_all(const fs::path& path) {
@@ -287,80 +417,6 @@ static std::optional<std::vector<Edit>> parse_edits_json(const std::string& text
 
   std::regex edit_re(R"EDITS(\{\s*"path"\s*:\s*"([^"]*)"\s*,\s*"start_line"\s*:\s*([0-9]+)\s*,\s*"end_line"\s*:\s*([0-9]+)\s*,\s*"replacement"\s*:\s*"((?:\\.|[^"\\])*)"\s*\})EDITS");
 
-  // 将 JSON 字符串字面量（不含外围引号）反转义成真实内容。
-  //
-  // 重要细节：要正确区分这两种情况：
-  // - "\n"  表示换行（应该变成真正的 '\n'）
-  // - "\\n" 表示两个字符：反斜杠 + n（应该保留为 "\\n"）
-  //
-  // 之前用简单的 regex_replace 会把 "\\n" 误处理成 "\<换行>"，导致 C++ 代码出现行续接。
-  auto json_unescape = [](const std::string& in, std::string& out,
-                          std::string& uerr) -> bool {
-    out.clear();
-    out.reserve(in.size());
-    for (std::size_t i = 0; i < in.size(); i++) {
-      char c = in[i];
-      if (c != '\\') {
-        out.push_back(c);
-        continue;
-      }
-      if (i + 1 >= in.size()) {
-        uerr = "invalid_escape_trailing_backslash";
-        return false;
-      }
-      char n = in[++i];
-      switch (n) {
-        case 'n':
-          out.push_back('\n');
-          break;
-        case 't':
-          out.push_back('\t');
-          break;
-        case 'r':
-          out.push_back('\r');
-          break;
-        case '"':
-          out.push_back('"');
-          break;
-        case '\\':
-          out.push_back('\\');
-          break;
-        case 'u': {
-          if (i + 4 >= in.size()) {
-            uerr = "invalid_unicode_escape";
-            return false;
-          }
-          unsigned int code = 0;
-          for (int k = 0; k < 4; k++) {
-            char h = in[i + 1 + k];
-            code <<= 4;
-            if (h >= '0' && h <= '9')
-              code |= static_cast<unsigned int>(h - '0');
-            else if (h >= 'a' && h <= 'f')
-              code |= static_cast<unsigned int>(10 + h - 'a');
-            else if (h >= 'A' && h <= 'F')
-              code |= static_cast<unsigned int>(10 + h - 'A');
-            else {
-              uerr = "invalid_unicode_escape";
-              return false;
-            }
-          }
-          i += 4;
-          // demo 版：只保证 ASCII 可读；更完整的 UTF-8 编码可作为后续增强点。
-          if (code <= 0x7F) {
-            out.push_back(static_cast<char>(code));
-          } else {
-            out.push_back('?');
-          }
-          break;
-        }
-        default:
-          uerr = "unsupported_escape";
-          return false;
-      }
-    }
-    return true;
-  };
   auto begin = std::sregex_iterator(text.begin(), text.end(), edit_re);
   auto end = std::sregex_iterator();
   for (auto it = begin; it != end; ++it) {
@@ -392,7 +448,8 @@ static std::string timestamp_id() {
   return std::to_string(ms);
 }
 
-static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path) {
+static std::string do_apply_edits(const fs::path& root,
+                                  const fs::path& edits_json_path) {
   // apply-edits：
   // - 输入：一个 edits.json（包含若干“文件路径 + 行号区间 + replacement”）
   // - 行为：
@@ -406,14 +463,12 @@ static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path
   // - 答辩时你可以强调：即使模型/规则出错，也不会把仓库改坏
   auto text_opt = read_text_file_all(edits_json_path);
   if (!text_opt.has_value()) {
-    std::cout << "{\"ok\":false,\"error\":\"edits_json_read_failed\"}\n";
-    return 2;
+    return "{\"ok\":false,\"error\":\"edits_json_read_failed\"}";
   }
   std::string parse_err;
   auto edits_opt = parse_edits_json(*text_opt, parse_err);
   if (!edits_opt.has_value()) {
-    std::cout << "{\"ok\":false,\"error\":\"" << json_escape(parse_err) << "\"}\n";
-    return 2;
+    return "{\"ok\":false,\"error\":\"" + json_escape(parse_err) + "\"}";
   }
 
   std::string snapshot_id = timestamp_id();
@@ -426,16 +481,14 @@ static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path
     fs::path abs = root / fs::path(e.path);
     auto content_opt = read_text_file_all(abs);
     if (!content_opt.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"file_read_failed\",\"path\":\""
-                << json_escape(e.path) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"file_read_failed\",\"path\":\"" +
+             json_escape(e.path) + "\"}";
     }
     auto lines = split_lines(*content_opt);
     if (e.start_line < 1 || e.end_line < e.start_line ||
         e.end_line > static_cast<int>(lines.size())) {
-      std::cout << "{\"ok\":false,\"error\":\"invalid_line_range\",\"path\":\""
-                << json_escape(e.path) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"invalid_line_range\",\"path\":\"" +
+             json_escape(e.path) + "\"}";
     }
 
     // Snapshot original.
@@ -443,9 +496,8 @@ static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path
     fs::create_directories(snap_path.parent_path(), ec);
     std::string write_err;
     if (!write_text_file_all(snap_path, *content_opt, write_err)) {
-      std::cout << "{\"ok\":false,\"error\":\"snapshot_write_failed\",\"path\":\""
-                << json_escape(e.path) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"snapshot_write_failed\",\"path\":\"" +
+             json_escape(e.path) + "\"}";
     }
 
     std::vector<std::string> repl_lines = split_lines(e.replacement);
@@ -455,9 +507,8 @@ static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path
 
     std::string updated = join_lines(lines);
     if (!write_text_file_all(abs, updated, write_err)) {
-      std::cout << "{\"ok\":false,\"error\":\"write_failed\",\"path\":\""
-                << json_escape(e.path) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"write_failed\",\"path\":\"" +
+             json_escape(e.path) + "\"}";
     }
     changed.push_back(e.path);
   }
@@ -465,17 +516,151 @@ static int cmd_apply_edits(const fs::path& root, const fs::path& edits_json_path
   std::sort(changed.begin(), changed.end());
   changed.erase(std::unique(changed.begin(), changed.end()), changed.end());
 
-  std::cout << "{\"ok\":true,\"snapshot_id\":\"" << json_escape(snapshot_id)
-            << "\",\"changed\":[";
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"snapshot_id\":\"" << json_escape(snapshot_id)
+      << "\",\"changed\":[";
   for (std::size_t i = 0; i < changed.size(); i++) {
-    if (i) std::cout << ",";
-    std::cout << "\"" << json_escape(changed[i]) << "\"";
+    if (i) oss << ",";
+    oss << "\"" << json_escape(changed[i]) << "\"";
   }
-  std::cout << "]}\n";
-  return 0;
+  oss << "]}";
+  return oss.str();
 }
 
-static int cmd_rollback(const fs::path& root, const std::string& snapshot_id) {
+static std::string do_warm(const fs::path& root) {
+  // warm：--serve 模式专用的“预热”。把工作区完整走一遍并把文件读进页缓存，
+  // 之后同一个常驻进程里的 search_text/read_file 都吃这口热缓存。
+  // 未来引擎有了倒排索引/tree-sitter 解析，首次构建也放在这里，
+  // 重试循环里的每次检索就都是增量的了。
+  std::size_t files = 0;
+  std::size_t bytes = 0;
+  std::error_code ec;
+  for (auto it = fs::recursive_directory_iterator(root, ec);
+       it != fs::recursive_directory_iterator(); it.increment(ec)) {
+    if (ec) break;
+    const auto& entry = *it;
+    fs::path rel = fs::relative(entry.path(), root, ec);
+    if (ec) continue;
+    if (should_ignore(rel)) {
+      if (entry.is_directory(ec)) it.disable_recursion_pending();
+      continue;
+    }
+    if (!entry.is_regular_file(ec)) continue;
+    std::string content;
+    if (!read_file_bytes(entry.path(), 200000, content)) continue;
+    files++;
+    bytes += content.size();
+  }
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"files\":" << files << ",\"bytes\":" << bytes << "}";
+  return oss.str();
+}
+
+static std::vector<std::string> split_csv(const std::string& s) { // 逗号分隔列表
+  std::vector<std::string> out;
+  std::string item;
+  std::istringstream iss(s);
+  while (std::getline(iss, item, ',')) {
+    if (!item.empty()) out.push_back(item);
+  }
+  return out;
+}
+
+static std::string do_insert_includes(const fs::path& root, const std::string& rel,
+                                      const std::vector<std::string>& headers) {
+  // insert-includes：
+  // - 输入：root 下的相对路径 + 要补的头文件名列表（如 thread,chrono）
+  // - 行为：快照原文件，然后把 #include <h> 插到最后一个 #include 之后
+  //   （文件里还没有 include 时插到最前面）
+  //
+  // 为什么放在引擎侧？
+  // - 旧流程是 read-file 把整个文件经 JSON 运回 Python，算好编辑后再让引擎
+  //   重新读一遍并重写 —— 文件内容跨进程来回两趟。
+  // - 在这里一步完成后，跨进程只需要传一个头文件名列表，读/改/写都留在引擎里。
+  if (headers.empty()) {
+    return "{\"ok\":false,\"error\":\"missing_headers\"}";
+  }
+  fs::path abs = root / fs::path(rel);
+  auto content_opt = read_text_file_all(abs);
+  if (!content_opt.has_value()) {
+    return "{\"ok\":false,\"error\":\"file_read_failed\",\"path\":\"" +
+           json_escape(rel) + "\"}";
+  }
+
+  std::string snapshot_id = timestamp_id();
+  fs::path snap_path = root / ".agent_snapshots" / snapshot_id / fs::path(rel);
+  std::error_code ec;
+  fs::create_directories(snap_path.parent_path(), ec);
+  std::string write_err;
+  if (!write_text_file_all(snap_path, *content_opt, write_err)) {
+    return "{\"ok\":false,\"error\":\"snapshot_write_failed\",\"path\":\"" +
+           json_escape(rel) + "\"}";
+  }
+
+  auto lines = split_lines(*content_opt);
+  std::size_t insert_at = 0;  // 最后一个 #include 行之后的下标
+  for (std::size_t i = 0; i < lines.size(); i++) {
+    if (lines[i].rfind("#include", 0) == 0) insert_at = i + 1;
+  }
+  std::vector<std::string> include_lines;
+  include_lines.reserve(headers.size());
+  for (const auto& h : headers) include_lines.push_back("#include <" + h + ">");
+  lines.insert(lines.begin() + static_cast<std::ptrdiff_t>(insert_at),
+               include_lines.begin(), include_lines.end());
+
+  if (!write_text_file_all(abs, join_lines(lines), write_err)) {
+    return "{\"ok\":false,\"error\":\"write_failed\",\"path\":\"" +
+           json_escape(rel) + "\"}";
+  }
+
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"snapshot_id\":\"" << json_escape(snapshot_id)
+      << "\",\"path\":\"" << json_escape(rel) << "\",\"inserted\":[";
+  for (std::size_t i = 0; i < headers.size(); i++) {
+    if (i) oss << ",";
+    oss << "\"" << json_escape(headers[i]) << "\"";
+  }
+  oss << "]}";
+  return oss.str();
+}
+
+static std::string do_fix_missing_includes(const fs::path& root,
+                                           const std::string& rel,
+                                           const std::vector<std::string>& headers) {
+  // fix-missing-includes：insert-includes 的“融合”版本 ——
+  // 过滤掉文件里已经有的 #include，再把剩下的插进去，一次 RPC 完成
+  // “读 → 查重 → 插入 → 快照 → 写回”。
+  //
+  // 为什么不让 Python 来过滤？
+  // - Python 过滤需要先 read_file 把整个文件运过去，查完重还是得让引擎
+  //   再读一遍来改 —— 又回到内容跨进程来回搬的老路。
+  // - 在引擎里过滤，跨进程始终只传头文件名列表和插入结果。
+  if (headers.empty()) {
+    return "{\"ok\":false,\"error\":\"missing_headers\"}";
+  }
+  fs::path abs = root / fs::path(rel);
+  auto content_opt = read_text_file_all(abs);
+  if (!content_opt.has_value()) {
+    return "{\"ok\":false,\"error\":\"file_read_failed\",\"path\":\"" +
+           json_escape(rel) + "\"}";
+  }
+  std::vector<std::string> missing;
+  for (const auto& h : headers) {
+    if (content_opt->find("#include <" + h + ">") == std::string::npos)
+      missing.push_back(h);
+  }
+  if (missing.empty()) {
+    // 全都已存在：没动文件，也就没有快照。让上层自己决定这算不算错。
+    return "{\"ok\":true,\"path\":\"" + json_escape(rel) +
+           "\",\"inserted\":[]}";
+  }
+  // 插入逻辑与 insert-includes 完全一致，直接复用（引擎本地多读一次文件
+  // 走的是页缓存，比起省掉的跨进程往返可以忽略）。
+  return do_insert_includes(root, rel, missing);
+}
+
+static std::string do_rollback(const fs::path& root,
+                               const std::string& snapshot_id) {
   // rollback：
   // - 输入：snapshot_id
   // - 行为：遍历 root/.agent_snapshots/<snapshot_id>/ 下的文件，并写回 root 对应位置
@@ -483,9 +668,8 @@ static int cmd_rollback(const fs::path& root, const std::string& snapshot_id) {
   fs::path snap_root = root / ".agent_snapshots" / snapshot_id;
   std::error_code ec;
   if (!fs::exists(snap_root, ec) || !fs::is_directory(snap_root, ec)) {
-    std::cout << "{\"ok\":false,\"error\":\"snapshot_not_found\",\"snapshot_id\":\""
-              << json_escape(snapshot_id) << "\"}\n";
-    return 2;
+    return "{\"ok\":false,\"error\":\"snapshot_not_found\",\"snapshot_id\":\"" +
+           json_escape(snapshot_id) + "\"}";
   }
 
   std::vector<std::string> restored;
@@ -502,15 +686,13 @@ static int cmd_rollback(const fs::path& root, const std::string& snapshot_id) {
 
     auto content_opt = read_text_file_all(entry.path());
     if (!content_opt.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"snapshot_read_failed\",\"path\":\""
-                << json_escape(to_posix_path(rel)) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"snapshot_read_failed\",\"path\":\"" +
+             json_escape(to_posix_path(rel)) + "\"}";
     }
     std::string write_err;
     if (!write_text_file_all(dest, *content_opt, write_err)) {
-      std::cout << "{\"ok\":false,\"error\":\"restore_write_failed\",\"path\":\""
-                << json_escape(to_posix_path(rel)) << "\"}\n";
-      return 2;
+      return "{\"ok\":false,\"error\":\"restore_write_failed\",\"path\":\"" +
+             json_escape(to_posix_path(rel)) + "\"}";
     }
     restored.push_back(to_posix_path(rel));
   }
@@ -518,13 +700,154 @@ static int cmd_rollback(const fs::path& root, const std::string& snapshot_id) {
   std::sort(restored.begin(), restored.end());
   restored.erase(std::unique(restored.begin(), restored.end()), restored.end());
 
-  std::cout << "{\"ok\":true,\"snapshot_id\":\"" << json_escape(snapshot_id)
-            << "\",\"restored\":[";
+  std::ostringstream oss;
+  oss << "{\"ok\":true,\"snapshot_id\":\"" << json_escape(snapshot_id)
+      << "\",\"restored\":[";
   for (std::size_t i = 0; i < restored.size(); i++) {
-    if (i) std::cout << ",";
-    std::cout << "\"" << json_escape(restored[i]) << "\"";
+    if (i) oss << ",";
+    oss << "\"" << json_escape(restored[i]) << "\"";
+  }
+  oss << "]}";
+  return oss.str();
+}
+
+static bool reply_ok(const std::string& json) {
+  // do_* 的成功输出都以 {"ok":true 开头（见上），用它换算进程退出码足够了。
+  return json.rfind("{\"ok\":true", 0) == 0;
+}
+
+static int emit(const std::string& json) {
+  // 一次性子命令模式：打印一行 JSON，并把 ok 映射成退出码（0=成功，2=失败）。
+  std::cout << json << "\n";
+  return reply_ok(json) ? 0 : 2;
+}
+
+// 处理 --serve 模式下的一条请求（不含 "id" 的包装，由 serve_loop 负责）。
+// 请求格式：{"id":N,"method":"search_text","params":{"root":"...","query":"...",...}}
+static std::string handle_request(const std::string& params,
+                                  const std::string& method) {
+  if (method == "list_files") {
+    auto root = json_get_string(params, "root");
+    if (!root.has_value()) return "{\"ok\":false,\"error\":\"missing_root\"}";
+    return do_list_files(fs::path(*root));
+  }
+  if (method == "read_file") {
+    auto path = json_get_string(params, "path");
+    if (!path.has_value()) return "{\"ok\":false,\"error\":\"missing_path\"}";
+    std::size_t max_bytes = 200000;
+    auto mb = json_get_int(params, "max_bytes");
+    if (mb.has_value()) max_bytes = static_cast<std::size_t>(*mb);
+    return do_read_file(fs::path(*path), max_bytes);
+  }
+  if (method == "search_text") {
+    auto root = json_get_string(params, "root");
+    auto query = json_get_string(params, "query");
+    if (!root.has_value() || !query.has_value())
+      return "{\"ok\":false,\"error\":\"missing_root_or_query\"}";
+    int topk = 10;
+    auto tk = json_get_int(params, "topk");
+    if (tk.has_value()) topk = static_cast<int>(*tk);
+    std::size_t max_bytes = 200000;
+    auto mb = json_get_int(params, "max_bytes");
+    if (mb.has_value()) max_bytes = static_cast<std::size_t>(*mb);
+    return do_search_text(fs::path(*root), *query, topk, max_bytes);
+  }
+  if (method == "apply_edits") {
+    auto root = json_get_string(params, "root");
+    auto edits_json = json_get_string(params, "edits_json");
+    if (!root.has_value() || !edits_json.has_value())
+      return "{\"ok\":false,\"error\":\"missing_root_or_edits_json\"}";
+    return do_apply_edits(fs::path(*root), fs::path(*edits_json));
+  }
+  if (method == "warm") {
+    auto root = json_get_string(params, "root");
+    if (!root.has_value()) return "{\"ok\":false,\"error\":\"missing_root\"}";
+    return do_warm(fs::path(*root));
+  }
+  if (method == "insert_includes") {
+    auto root = json_get_string(params, "root");
+    auto path = json_get_string(params, "path");
+    auto headers = json_get_string(params, "headers");  // 逗号分隔，适配轻量 JSON 解析
+    if (!root.has_value() || !path.has_value() || !headers.has_value())
+      return "{\"ok\":false,\"error\":\"missing_root_path_or_headers\"}";
+    return do_insert_includes(fs::path(*root), *path, split_csv(*headers));
+  }
+  if (method == "fix_missing_includes") {
+    auto root = json_get_string(params, "root");
+    auto path = json_get_string(params, "path");
+    auto headers = json_get_string(params, "headers");  // 逗号分隔，适配轻量 JSON 解析
+    if (!root.has_value() || !path.has_value() || !headers.has_value())
+      return "{\"ok\":false,\"error\":\"missing_root_path_or_headers\"}";
+    return do_fix_missing_includes(fs::path(*root), *path, split_csv(*headers));
+  }
+  if (method == "rollback") {
+    auto root = json_get_string(params, "root");
+    auto sid = json_get_string(params, "snapshot_id");
+    if (!root.has_value() || !sid.has_value())
+      return "{\"ok\":false,\"error\":\"missing_root_or_snapshot_id\"}";
+    return do_rollback(fs::path(*root), *sid);
+  }
+  return "{\"ok\":false,\"error\":\"unknown_method\",\"method\":\"" +
+         json_escape(method) + "\"}";
+}
+
+// 结果超过这个大小就不挤管道了，写进 Python 侧创建的共享内存段
+static constexpr std::size_t kShmSpillBytes = 64 * 1024;
+
+static bool shm_write(const std::string& name, const std::string& data) {
+  // 把 data 写进已存在的 POSIX 共享内存段（由 Python 的
+  // multiprocessing.shared_memory 创建；POSIX 名字带前导 '/'）。
+  // 任何一步失败都返回 false，调用方退回管道路径即可。
+#ifdef ENGINE_HAS_SHM
+  int fd = shm_open(("/" + name).c_str(), O_RDWR, 0);
+  if (fd < 0) return false;
+  void* mem = mmap(nullptr, data.size(), PROT_WRITE, MAP_SHARED, fd, 0);
+  close(fd);
+  if (mem == MAP_FAILED) return false;
+  std::memcpy(mem, data.data(), data.size());
+  munmap(mem, data.size());
+  return true;
+#else
+  (void)name;
+  (void)data;
+  return false;
+#endif
+}
+
+static int serve_loop() {
+  // --serve 常驻模式：一行请求 → 一行应答（NDJSON）。
+  // stdin 被对端关闭（EOF）即退出，所以 Python 进程结束时引擎会自动跟着退出。
+  std::string line;
+  while (std::getline(std::cin, line)) {
+    if (line.empty()) continue;
+    long long id = json_get_int(line, "id").value_or(0);
+    std::string method = json_get_string(line, "method").value_or("");
+    // 只在 "params" 之后的子串里找参数，避免 query 文本里恰好包含别的键名。
+    std::size_t p = line.find("\"params\"");
+    std::string params = (p == std::string::npos) ? line : line.substr(p);
+    std::string result;
+    if (method == "shutdown") {
+      // 显式下线（EngineClient.close 会发）：回一条确认再退出循环
+      std::cout << "{\"id\":" << id << ",\"ok\":true}\n" << std::flush;
+      break;
+    }
+    result = handle_request(params, method);
+    // 大应答直写共享内存（客户端通过 params.shm/cap 声明了可用的段），
+    // 管道上只回一个几十字节的存根 —— 大结果不用整个穿过内核管道缓冲。
+    std::string shm_name = json_get_string(params, "shm").value_or("");
+    long long shm_cap = json_get_int(params, "cap").value_or(0);
+    if (!shm_name.empty() && result.size() > kShmSpillBytes &&
+        result.size() <= static_cast<std::size_t>(shm_cap) &&
+        shm_write(shm_name, result)) {
+      std::cout << "{\"id\":" << id << ",\"ok\":true,\"shm\":true,\"bytes\":"
+                << result.size() << "}\n"
+                << std::flush;
+      continue;
+    }
+    // 把 "id" 注入应答最前面：result 一定以 '{' 开头。
+    std::cout << "{\"id\":" << id << "," << result.substr(1) << "\n"
+              << std::flush;
   }
-  std::cout << "]}\n";
   return 0;
 }
 
@@ -545,33 +868,34 @@ int main(int argc, char** argv) {
   }
   std::string cmd = argv[1];
 
+  if (cmd == "--serve") {
+    return serve_loop();
+  }
+
   if (cmd == "list-files") {
     auto root = arg_value(argc, argv, std::string("--root"));
     if (!root.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"missing_root\"}\n";
-      return 2;
+      return emit("{\"ok\":false,\"error\":\"missing_root\"}");
     }
-    return cmd_list_files(fs::path(*root));
+    return emit(do_list_files(fs::path(*root)));
   }
 
   if (cmd == "read-file") {
     auto path = arg_value(argc, argv, std::string("--path"));
     if (!path.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"missing_path\"}\n";
-      return 2;
+      return emit("{\"ok\":false,\"error\":\"missing_path\"}");
     }
     std::size_t max_bytes = 200000;
     auto mb = arg_value(argc, argv, std::string("--max-bytes"));
     if (mb.has_value()) max_bytes = static_cast<std::size_t>(std::stoull(*mb));
-    return cmd_read_file(fs::path(*path), max_bytes);
+    return emit(do_read_file(fs::path(*path), max_bytes));
   }
 
   if (cmd == "search-text") {
     auto root = arg_value(argc, argv, std::string("--root"));
     auto query = arg_value(argc, argv, std::string("--query"));
     if (!root.has_value() || !query.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"missing_root_or_query\"}\n";
-      return 2;
+      return emit("{\"ok\":false,\"error\":\"missing_root_or_query\"}");
     }
     int topk = 10;
     auto tk = arg_value(argc, argv, std::string("--topk"));
@@ -579,27 +903,45 @@ int main(int argc, char** argv) {
     std::size_t max_bytes = 200000;
     auto mb = arg_value(argc, argv, std::string("--max-bytes"));
     if (mb.has_value()) max_bytes = static_cast<std::size_t>(std::stoull(*mb));
-    return cmd_search_text(fs::path(*root), *query, topk, max_bytes);
+    return emit(do_search_text(fs::path(*root), *query, topk, max_bytes));
   }
 
   if (cmd == "apply-edits") {
     auto root = arg_value(argc, argv, std::string("--root"));
     auto edits_json = arg_value(argc, argv, std::string("--edits-json"));
     if (!root.has_value() || !edits_json.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"missing_root_or_edits_json\"}\n";
-      return 2;
+      return emit("{\"ok\":false,\"error\":\"missing_root_or_edits_json\"}");
+    }
+    return emit(do_apply_edits(fs::path(*root), fs::path(*edits_json)));
+  }
+
+  if (cmd == "insert-includes") {
+    auto root = arg_value(argc, argv, std::string("--root"));
+    auto path = arg_value(argc, argv, std::string("--path"));
+    auto headers = arg_value(argc, argv, std::string("--headers"));
+    if (!root.has_value() || !path.has_value() || !headers.has_value()) {
+      return emit("{\"ok\":false,\"error\":\"missing_root_path_or_headers\"}");
+    }
+    return emit(do_insert_includes(fs::path(*root), *path, split_csv(*headers)));
+  }
+
+  if (cmd == "fix-missing-includes") {
+    auto root = arg_value(argc, argv, std::string("--root"));
+    auto path = arg_value(argc, argv, std::string("--path"));
+    auto headers = arg_value(argc, argv, std::string("--headers"));
+    if (!root.has_value() || !path.has_value() || !headers.has_value()) {
+      return emit("{\"ok\":false,\"error\":\"missing_root_path_or_headers\"}");
     }
-    return cmd_apply_edits(fs::path(*root), fs::path(*edits_json));
+    return emit(do_fix_missing_includes(fs::path(*root), *path, split_csv(*headers)));
   }
 
   if (cmd == "rollback") {
     auto root = arg_value(argc, argv, std::string("--root"));
     auto sid = arg_value(argc, argv, std::string("--snapshot-id"));
     if (!root.has_value() || !sid.has_value()) {
-      std::cout << "{\"ok\":false,\"error\":\"missing_root_or_snapshot_id\"}\n";
-      return 2;
+      return emit("{\"ok\":false,\"error\":\"missing_root_or_snapshot_id\"}");
     }
-    return cmd_rollback(fs::path(*root), *sid);
+    return emit(do_rollback(fs::path(*root), *sid));
   }
 
   print_usage(argv[0]);